@@ -5,7 +5,7 @@ from twisted.protocols.basic import LineOnlyReceiver, Int32StringReceiver
 from carbon import log, events, state, management
 from carbon.conf import settings
 from carbon.regexlist import WhiteList, BlackList
-from carbon.util import pickle, get_unpickler
+from carbon.util import pickle, get_unpickler, pack_datapoints
 
 
 class MetricReceiver:
@@ -124,10 +124,24 @@ class CacheManagementHandler(Int32StringReceiver):
     if request['type'] == 'cache-query':
       metric = request['metric']
       datapoints = MetricCache.get(metric, [])
-      result = dict(datapoints=datapoints)
+      if request.get('packed'):
+        result = dict(datapoints_packed=pack_datapoints(datapoints))
+      else:
+        result = dict(datapoints=datapoints)
       log.query('[%s] cache query for \"%s\" returned %d values' % (self.peerAddr, metric, len(datapoints)))
       instrumentation.increment('cacheQueries')
 
+    elif request['type'] == 'bulk-cache-query':
+      metrics = request['metrics']
+      datapoints = dict( (metric, MetricCache.get(metric, [])) for metric in metrics )
+      if request.get('packed'):
+        packed = dict( (metric, pack_datapoints(points)) for (metric, points) in datapoints.items() )
+        result = dict(datapoints_packed=packed)
+      else:
+        result = dict(datapoints=datapoints)
+      log.query('[%s] bulk cache query for %d metrics' % (self.peerAddr, len(metrics)))
+      instrumentation.increment('cacheQueries', len(metrics))
+
     elif request['type'] == 'get-metadata':
       result = management.getMetadata(request['metric'], request['key'])
 
@@ -137,7 +151,9 @@ class CacheManagementHandler(Int32StringReceiver):
     else:
       result = dict(error="Invalid request type \"%s\"" % request['type'])
 
-    response = pickle.dumps(result, protocol=-1)
+    # Reply in the protocol the client asked for, capped at the highest we support
+    protocol = min(request.get('protocol_version', pickle.HIGHEST_PROTOCOL), pickle.HIGHEST_PROTOCOL)
+    response = pickle.dumps(result, protocol=protocol)
     self.sendString(response)
 
 
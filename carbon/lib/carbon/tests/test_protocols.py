@@ -0,0 +1,103 @@
+import struct
+from unittest import TestCase
+from carbon.conf import settings
+settings.setdefault("CONF_DIR", "") # carbon.storage reads it at import, read_config() normally sets it
+from carbon.cache import MetricCache
+from carbon.protocols import CacheManagementHandler
+from carbon.util import pickle, get_unpickler, pack_datapoints
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# The layout the webapp reads packed datapoints back with
+PACKED_DATAPOINT = [('ts', '>i8'), ('val', '>f8')]
+
+
+class PackDatapointsTest(TestCase):
+
+    def test_empty(self):
+        """Packing no datapoints gives an empty string."""
+        self.assertEqual("", pack_datapoints([]))
+
+    def test_big_endian_pairs(self):
+        """Each datapoint is packed as a big-endian int64 and float64."""
+        packed = pack_datapoints([(1300000000.7, 1.5), (1300000060, -2.0)])
+        self.assertEqual(32, len(packed))
+        self.assertEqual((1300000000, 1.5, 1300000060, -2.0),
+                         struct.unpack(">qdqd", packed))
+
+    def test_numpy_round_trip(self):
+        """The webapp can load packed datapoints with numpy.frombuffer."""
+        if numpy is None:
+            return
+        datapoints = [(1300000000, 1.5), (1300000060, 2.25)]
+        unpacked = numpy.frombuffer(pack_datapoints(datapoints),
+                                    dtype=numpy.dtype(PACKED_DATAPOINT))
+        self.assertEqual([1300000000, 1300000060], unpacked['ts'].tolist())
+        self.assertEqual([1.5, 2.25], unpacked['val'].tolist())
+
+
+class CacheManagementHandlerTest(TestCase):
+
+    def setUp(self):
+        self.handler = CacheManagementHandler()
+        self.handler.peerAddr = "127.0.0.1:7002"
+        self.handler.unpickler = get_unpickler()
+        self.sent = []
+        self.handler.sendString = self.sent.append
+        MetricCache.store("foo.bar", (1300000000, 1.0))
+        MetricCache.store("foo.bar", (1300000060, 2.0))
+        MetricCache.store("foo.baz", (1300000000, 3.0))
+
+    def tearDown(self):
+        for metric in MetricCache.keys():
+            MetricCache.pop(metric)
+
+    def query(self, **request):
+        self.handler.stringReceived(pickle.dumps(request))
+        self.assertEqual(1, len(self.sent))
+        return pickle.loads(self.sent.pop())
+
+    def test_cache_query(self):
+        """A cache query returns the cached datapoints of one metric."""
+        result = self.query(type="cache-query", metric="foo.bar")
+        self.assertEqual([(1300000000, 1.0), (1300000060, 2.0)],
+                         result["datapoints"])
+
+    def test_cache_query_packed(self):
+        """A packed cache query returns the datapoints packed."""
+        result = self.query(type="cache-query", metric="foo.bar", packed=True)
+        self.assertEqual(pack_datapoints([(1300000000, 1.0), (1300000060, 2.0)]),
+                         result["datapoints_packed"])
+
+    def test_bulk_cache_query(self):
+        """A bulk cache query returns the datapoints of every metric asked for."""
+        result = self.query(type="bulk-cache-query",
+                            metrics=["foo.bar", "foo.baz", "foo.missing"])
+        self.assertEqual({"foo.bar": [(1300000000, 1.0), (1300000060, 2.0)],
+                          "foo.baz": [(1300000000, 3.0)],
+                          "foo.missing": []},
+                         result["datapoints"])
+
+    def test_bulk_cache_query_packed(self):
+        """A packed bulk cache query packs each metric's datapoints."""
+        result = self.query(type="bulk-cache-query",
+                            metrics=["foo.bar", "foo.missing"], packed=True)
+        packed = result["datapoints_packed"]
+        self.assertEqual(["foo.bar", "foo.missing"], sorted(packed))
+        self.assertEqual("", packed["foo.missing"])
+        if numpy is None:
+            return
+        unpacked = numpy.frombuffer(packed["foo.bar"],
+                                    dtype=numpy.dtype(PACKED_DATAPOINT))
+        self.assertEqual([1300000000, 1300000060], unpacked['ts'].tolist())
+        self.assertEqual([1.0, 2.0], unpacked['val'].tolist())
+
+    def test_protocol_version(self):
+        """The response uses the pickle protocol the client asked for."""
+        self.handler.stringReceived(pickle.dumps(
+            dict(type="cache-query", metric="foo.bar", protocol_version=0)))
+        self.assertTrue(self.sent[0].startswith("(dp"))
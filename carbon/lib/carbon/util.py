@@ -1,6 +1,7 @@
 import sys
 import os
 import pwd
+import struct
 
 from os.path import abspath, basename, dirname, join
 try:
@@ -30,6 +31,16 @@ def dropprivs(user):
   return (uid, gid)
 
 
+def pack_datapoints(datapoints):
+  """Packs (timestamp, value) datapoints into big-endian (int64, float64) pairs,
+  which the webapp can load without unpickling a tuple per datapoint"""
+  flat = []
+  for (timestamp, value) in datapoints:
+    flat.append( int(timestamp) )
+    flat.append( value )
+  return struct.pack('!' + ('qd' * len(datapoints)), *flat)
+
+
 def run_twistd_plugin(filename):
     from carbon.conf import get_parser
     from twisted.scripts.twistd import ServerOptions
@@ -50,6 +50,14 @@ try:
 except:
   print "[FATAL] Failed to create text with cairo, this probably means cairo cant find any fonts. Install some system fonts and try again"
 
+# Test for numpy
+try:
+  import numpy
+except:
+  print "[FATAL] Unable to import the 'numpy' module, do you have numpy installed for python %s?" % py_version
+  fatal += 1
+
+
 # Test for django
 try:
   import django
@@ -117,6 +125,29 @@ except:
   warning += 1
 
 
+# Test for numba
+try:
+  import numba
+except:
+  print "[WARNING]"
+  print "Unable to import the 'numba' module, do you have numba installed for python %s?" % py_version
+  print "This feature is not required but speeds up resampling of Hypertable data.\n"
+  warning += 1
+
+
+# Test for scandir
+try:
+  try:
+    from os import scandir
+  except ImportError:
+    from scandir import scandir
+except:
+  print "[WARNING]"
+  print "Unable to import the 'scandir' module, do you have scandir installed for python %s?" % py_version
+  print "This feature is not required but speeds up metric searches on large trees.\n"
+  warning += 1
+
+
 # Test for sqlite
 try:
   try:
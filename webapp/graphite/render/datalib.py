@@ -13,12 +13,15 @@ See the License for the specific language governing permissions and
 limitations under the License."""
 
 import array
+import calendar
+import math
 import re
 import socket
 import struct
 import time
 import datetime
 from collections import defaultdict
+import numpy as np
 from django.conf import settings
 from graphite.logger import log
 from graphite.storage import STORE, LOCAL_STORE
@@ -32,13 +35,31 @@ try:
 except ImportError:
   import pickle
 
+try:
+  from numba import njit
+except ImportError:
+  njit = False
+
+# CarbonLink messages are framed by a 4-byte length prefix
+packLength = struct.Struct("!L").pack
+unpackLength = struct.Struct("!L").unpack
+
+# Packed CarbonLink datapoints are big-endian (timestamp, value) pairs
+packedDatapoint = np.dtype([('ts', '>i8'), ('val', '>f8')])
+
 
 class TimeSeries(list):
+  # Every attribute set on a series anywhere in the webapp has to be listed here
+  __slots__ = ('name', 'start', 'end', 'step', 'consolidationFunc', 'valuesPerPoint', 'options',
+               'pathExpression', 'color', 'xStep')
+
   def __init__(self, name, start, end, step, values, consolidate='average'):
     self.name = name
     self.start = start
     self.end = end
     self.step = step
+    if isinstance(values, np.ndarray): # resampled data, NaN marks missing datapoints
+      values = nanToNone(values)
     list.__init__(self,values)
     self.consolidationFunc = consolidate
     self.valuesPerPoint = 1
@@ -46,7 +67,7 @@ class TimeSeries(list):
 
   def __iter__(self):
     if self.valuesPerPoint > 1:
-      return self.__consolidatingGenerator( list.__iter__(self) )
+      return iter( self.__consolidate() )
     else:
       return list.__iter__(self)
 
@@ -55,31 +76,38 @@ class TimeSeries(list):
     self.valuesPerPoint = int(valuesPerPoint)
 
 
-  def __consolidatingGenerator(self, gen):
-    buf = []
-    for x in gen:
-      buf.append(x)
-      if len(buf) == self.valuesPerPoint:
-        while None in buf: buf.remove(None)
-        if buf:
-          yield self.__consolidate(buf)
-          buf = []
-        else:
-          yield None
-    while None in buf: buf.remove(None)
-    if buf: yield self.__consolidate(buf)
-    else: yield None
-    raise StopIteration
-
-
-  def __consolidate(self, values):
-    usable = [v for v in values if v is not None]
-    if not usable: return None
+  def __consolidate(self):
+    valuesPerPoint = self.valuesPerPoint
+    numValues = list.__len__(self)
+    numPoints = numValues // valuesPerPoint + 1 # a series that divides evenly still ends with an empty bucket
+
+    # Lay the values out as one row per point, padding the last row with NaN
+    buckets = np.empty(numPoints * valuesPerPoint, dtype=np.float64)
+    buckets[:numValues] = self[:] # None becomes NaN
+    buckets[numValues:] = np.nan
+    buckets = buckets.reshape(numPoints, valuesPerPoint)
+
+    known = ~np.isnan(buckets)
+    counts = known.sum(axis=1)
+    sums = np.where(known, buckets, 0.0).sum(axis=1)
+
     if self.consolidationFunc == 'sum':
-      return sum(usable)
-    if self.consolidationFunc == 'average':
-      return float(sum(usable)) / len(usable)
-    raise Exception, "Invalid consolidation function!"
+      results = sums
+    elif self.consolidationFunc == 'average':
+      results = sums / np.maximum(counts, 1)
+    else:
+      raise Exception, "Invalid consolidation function!"
+
+    return [ (value if count else None) for (value, count) in zip(results.tolist(), counts.tolist()) ]
+
+
+  def __getstate__(self): # slotted classes need these to be pickled (ie. by the data cache)
+    return dict( (attr, getattr(self, attr)) for attr in self.__slots__ if hasattr(self, attr) )
+
+
+  def __setstate__(self, state):
+    for (attr, value) in state.items():
+      setattr(self, attr, value)
 
 
   def __repr__(self):
@@ -134,13 +162,59 @@ class CarbonLinkPool:
       raise
     else:
       connection.setsockopt( socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 )
+      # Requests are small and we block on each reply, so don't let Nagle hold them back.
+      # Bulk writers sending many small packets back to back should leave Nagle enabled.
+      connection.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
       return connection
 
   def query(self, metric):
-    request = dict(type='cache-query', metric=metric)
+    request = dict(type='cache-query', metric=metric, packed=True)
     results = self.send_request(request)
-    log.cache("CarbonLink cache-query request for %s returned %d datapoints" % (metric, len(results)))
-    return results['datapoints']
+    if 'datapoints_packed' in results:
+      datapoints = unpackDatapoints(results['datapoints_packed'])
+    else: # carbon-caches that predate packed replies ignore the flag
+      datapoints = results['datapoints']
+    log.cache("CarbonLink cache-query request for %s returned %d datapoints" % (metric, len(datapoints)))
+    return datapoints
+
+  def query_bulk(self, metrics):
+    """Returns a dict of cached datapoints for each metric, using one request per carbon host.
+    A host that fails leaves its metrics out of the results without affecting the other hosts"""
+    metricsByHost = defaultdict(list)
+    for metric in metrics:
+      metricsByHost[ self.select_host(metric) ].append(metric)
+
+    datapoints = {}
+    for (host, hostMetrics) in metricsByHost.items():
+      try:
+        hostDatapoints = self.query_host(host, hostMetrics)
+      except CarbonLinkRequestError: # carbon-caches that predate bulk-cache-query reject it
+        hostDatapoints = self.query_each(hostMetrics)
+      except:
+        log.exception("CarbonLink bulk-cache-query request to %s failed" % str(host))
+        continue
+
+      datapoints.update(hostDatapoints)
+      log.cache("CarbonLink bulk-cache-query request for %d metrics on %s returned %d datapoints" % (len(hostMetrics), str(host), sum(len(points) for points in hostDatapoints.values())))
+    return datapoints
+
+  def query_host(self, host, metrics):
+    request = dict(type='bulk-cache-query', metrics=metrics, packed=True)
+    results = self.send_request_to_host(host, request)
+    if 'datapoints_packed' in results:
+      return dict( (metric, unpackDatapoints(packed)) for (metric, packed) in results['datapoints_packed'].items() )
+    else:
+      return results['datapoints']
+
+  def query_each(self, metrics):
+    "Queries metrics one at a time, skipping the ones that fail"
+    datapoints = {}
+    for metric in metrics:
+      try:
+        datapoints[metric] = self.query(metric)
+      except:
+        log.exception("CarbonLink cache-query request for %s failed" % metric)
+    return datapoints
 
   def get_metadata(self, metric, key):
     request = dict(type='get-metadata', metric=metric, key=key)
@@ -155,12 +229,15 @@ class CarbonLinkPool:
     return results
 
   def send_request(self, request):
-    metric = request['metric']
-    serialized_request = pickle.dumps(request, protocol=-1)
-    len_prefix = struct.pack("!L", len(serialized_request))
+    host = self.select_host(request['metric'])
+    return self.send_request_to_host(host, request)
+
+  def send_request_to_host(self, host, request):
+    request['protocol_version'] = pickle.HIGHEST_PROTOCOL # ask carbon to reply in the same protocol
+    serialized_request = pickle.dumps(request, protocol=pickle.HIGHEST_PROTOCOL)
+    len_prefix = packLength(len(serialized_request))
     request_packet = len_prefix + serialized_request
 
-    host = self.select_host(metric)
     conn = self.get_connection(host)
     try:
       conn.sendall(request_packet)
@@ -177,7 +254,7 @@ class CarbonLinkPool:
 
   def recv_response(self, conn):
     len_prefix = recv_exactly(conn, 4)
-    body_size = struct.unpack("!L", len_prefix)[0]
+    body_size = unpackLength(len_prefix)[0]
     body = recv_exactly(conn, body_size)
     return pickle.loads(body)
 
@@ -186,15 +263,22 @@ class CarbonLinkPool:
 class CarbonLinkRequestError(Exception):
   pass
 
+def unpackDatapoints(packed):
+  "Loads packed CarbonLink datapoints into an array of (ts, val) records"
+  return np.frombuffer(packed, dtype=packedDatapoint)
+
 def recv_exactly(conn, num_bytes):
-  buf = ''
-  while len(buf) < num_bytes:
-    data = conn.recv( num_bytes - len(buf) )
-    if not data:
+  # Read straight into a preallocated buffer rather than concatenating strings
+  buf = bytearray(num_bytes)
+  view = memoryview(buf)
+  received = 0
+  while received < num_bytes:
+    count = conn.recv_into( view[received:], num_bytes - received )
+    if not count:
       raise Exception("Connection lost")
-    buf += data
+    received += count
 
-  return buf
+  return bytes(buf)
 
 #parse hosts from local_settings.py
 hosts = []
@@ -241,7 +325,7 @@ def fetchDataFromHyperTable(requestContext, pathExpr):
   startDateTime = requestContext['startTime']
   endDateTime = requestContext['endTime']
 
-  start, end = int(timestamp(requestContext['startTime'])), int(timestamp(requestContext['endTime']))
+  start, end = int(timestamp(startDateTime)), int(timestamp(endDateTime))
 
   startColString = startDateTime.strftime('metric:%Y-%m-%d %H')
   endColString = endDateTime.strftime('metric:%Y-%m-%d %H')
@@ -263,37 +347,66 @@ def fetchDataFromHyperTable(requestContext, pathExpr):
   log.info(endDateTime)
   log.info(scan_spec)
 
-  valuesMap = defaultdict(list)
+  # Per-metric timestamp and value buffers, indexed by metric id, so scanned
+  # cells are appended without allocating a tuple (or a dict entry) per cell
+  metricIds = dict( (m, i) for (i, m) in enumerate(metrics) )
+  timestampBuffers = [ array.array('l') for m in metrics ]
+  valueBuffers = [ array.array('d') for m in metrics ]
 
   def processResult(key, family, column, val, ts):
-    its = long(ts) / 10**9L  #nanoseconds -> seconds
-    valuesMap[key].append((its, val))
+    i = metricIds[key]
+    timestampBuffers[i].append( long(ts) / 10**9L ) #nanoseconds -> seconds
+    valueBuffers[i].append( float(val) )
 
 
 
   HyperTablePool.doScan(scan_spec, "metrics", processResult)
 
-  elapsed = end - start
+  seriesList = []
+  for (m, i) in sorted(metricIds.items()):
+    (timestamps, values) = (timestampBuffers[i], valueBuffers[i])
+    if not timestamps: # nothing stored for this metric in the time range
+      continue
 
-  for m in valuesMap.keys():
     # resample everything to 'best' granularity
     steps = int(end - start) / metricRate[m]
 
     # push final values
-    finalValues = [None] * steps
-    for x in valuesMap[m]:
-      bucket = int(min(round(float(x[0] - start) / float(metricRate[m])), steps - 1))
-      finalValues[bucket] = float(x[1])
-    valuesMap[m] = finalValues
+    finalValues = np.empty(steps, dtype=np.float64)
+    finalValues.fill(np.nan)
+    if steps > 0:
+      bucketize(np.frombuffer(timestamps, dtype=np.int_).astype(np.int64, copy=False),
+                np.frombuffer(values, dtype=np.float64), start, int(metricRate[m]), steps, finalValues)
 
-  seriesList = []
-  for m in sorted(valuesMap.keys()):
-    series = TimeSeries(removePrefix(m), start, end, metricRate[m], valuesMap[m])
+    series = TimeSeries(removePrefix(m), start, end, metricRate[m], finalValues)
     series.pathExpression = pathExpr # hack to pass expressions through to render functions
     seriesList.append(series)
 
   return seriesList
 
+def bucketize(timestamps, values, start, step, steps, out):
+  "Resamples (timestamp, value) pairs into out, a preallocated array of steps buckets"
+  buckets = np.floor((timestamps - start) / float(step) + 0.5).astype(np.intp)
+  np.clip(buckets, 0, steps - 1, out=buckets)
+  out[buckets] = values # later datapoints overwrite earlier ones in the same bucket
+
+def bucketizeLoop(timestamps, values, start, step, steps, out):
+  "Scalar version of bucketize() for numba to compile"
+  for i in range(len(timestamps)):
+    bucket = int(math.floor((timestamps[i] - start) / float(step) + 0.5))
+    if bucket >= steps:
+      bucket = steps - 1
+    elif bucket < 0:
+      bucket = 0
+    out[bucket] = values[i]
+
+if njit:
+  # compile eagerly so a broken numba install shows up here rather than mid-request
+  try:
+    bucketize = njit('void(int64[:], float64[:], int64, int64, int64, float64[:])')(bucketizeLoop)
+  except Exception:
+    log.exception("numba failed to compile bucketize, using the NumPy version")
+
 def fetchDataLocal(requestContext, pathExpr):
   seriesList = []
   startTime = requestContext['startTime']
@@ -304,12 +417,22 @@ def fetchDataLocal(requestContext, pathExpr):
   else:
     store = STORE
 
-  for dbFile in store.find(pathExpr):
+  dbFiles = list( store.find(pathExpr) )
+
+  # Fetch the cached datapoints for every matched metric at once
+  try:
+    cachedResults = CarbonLink.query_bulk([dbFile.real_metric for dbFile in dbFiles])
+  except:
+    log.exception()
+    cachedResults = {}
+
+  (fromTime, untilTime) = ( timestamp(startTime), timestamp(endTime) )
+
+  for dbFile in dbFiles:
     log.metric_access(dbFile.metric_path)
-    dbResults = dbFile.fetch( timestamp(startTime), timestamp(endTime) )
+    dbResults = dbFile.fetch(fromTime, untilTime)
     try:
-      cachedResults = CarbonLink.query(dbFile.real_metric)
-      results = mergeResults(dbResults, cachedResults)
+      results = mergeResults(dbResults, cachedResults.get(dbFile.real_metric, []))
     except:
       log.exception()
       results = dbResults
@@ -327,29 +450,41 @@ def fetchDataLocal(requestContext, pathExpr):
 
 
 def mergeResults(dbResults, cacheResults):
-  cacheResults = list(cacheResults)
-
   if not dbResults:
-    return cacheResults
-  elif not cacheResults:
+    return list(cacheResults)
+  elif not len(cacheResults):
     return dbResults
 
   (timeInfo,values) = dbResults
   (start,end,step) = timeInfo
 
-  for (timestamp, value) in cacheResults:
-    interval = timestamp - (timestamp % step)
+  if isinstance(cacheResults, np.ndarray): # packed datapoints, scatter them all at once
+    timestamps = cacheResults['ts'].astype(np.int64)
+    mergedValues = np.array(values, dtype=np.float64) # None becomes NaN
+    indices = (timestamps - (timestamps % step) - start) // step
+    inRange = (indices >= 0) & (indices < len(mergedValues))
+    mergedValues[ indices[inRange] ] = cacheResults['val'][inRange]
+    return (timeInfo, nanToNone(mergedValues))
 
-    try:
-      i = int(interval - start) / step
+  # (timestamp, value) tuples from carbon-caches that predate packed replies
+  numValues = len(values)
+  for (timestamp, value) in cacheResults:
+    i = int(timestamp - (timestamp % step) - start) // step
+    if 0 <= i < numValues:
       values[i] = value
-    except:
-      pass
 
   return (timeInfo,values)
 
 
+def nanToNone(values):
+  "Converts a float array into a list of values, with None for missing (NaN) datapoints"
+  return [ (v if v == v else None) for v in values.tolist() ]
+
+
 def timestamp(datetime):
   "Convert a datetime object into epoch time"
-  return time.mktime( datetime.timetuple() )
+  if datetime.tzinfo is None: # naive datetimes are in local time
+    return time.mktime( datetime.timetuple() )
+  else:
+    return float( calendar.timegm( datetime.utctimetuple() ) )
 
@@ -76,6 +76,8 @@ DOCUMENTATION_URL = "http://graphite.readthedocs.org/"
 ALLOW_ANONYMOUS_CLI = True
 LOG_METRIC_ACCESS = False
 LEGEND_MAX_ITEMS = 10
+REALPATH_CACHE_DURATION = 300 #resolved whisper file symlinks are remembered for five minutes
+METRIC_INDEX_REFRESH_INTERVAL = 0 #if set, finds use an in-memory index of DATA_DIRS rebuilt this often (seconds)
 
 #Authentication settings
 USE_LDAP_AUTH = False
@@ -1,7 +1,9 @@
-import os, time, fnmatch, socket, errno
+import os, re, time, fnmatch, socket, select, errno, threading
 from os.path import isdir, isfile, join, exists, splitext, basename, realpath
+from collections import deque
 import whisper
 from graphite.remote_storage import RemoteStore
+from graphite.logger import log
 from django.conf import settings
 
 try:
@@ -14,6 +16,14 @@ try:
 except ImportError:
   gzip = False
 
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = False
+
 try:
   import cPickle as pickle
 except ImportError:
@@ -21,6 +31,7 @@ except ImportError:
 
 
 DATASOURCE_DELIMETER = '::RRD_DATASOURCE::'
+REALPATH_CACHE_SIZE = 65536
 
 
 
@@ -65,8 +76,8 @@ class Store:
     # If nothing found earch remotely
     remote_requests = [ r.find(query) for r in self.remote_stores if r.available ]
 
-    for request in remote_requests:
-      for match in request.get_results():
+    for results in self.gather_results(remote_requests):
+      for match in results:
         return match
 
 
@@ -83,34 +94,61 @@ class Store:
           found.add(match.metric_path)
 
     # Gather remote search results
-    for request in remote_requests:
-      for match in request.get_results():
+    for results in self.gather_results(remote_requests):
+      for match in results:
 
         if match.metric_path not in found:
           yield match
           found.add(match.metric_path)
 
 
+  def gather_results(self, remote_requests):
+    "Generates the results of each remote request in the order their responses arrive"
+    pending = {}
+    for request in remote_requests:
+      sock = request.connection and request.connection.sock
+      if sock is None: # cached, or the request could not be sent
+        yield request.get_results()
+      else:
+        pending[sock] = request
+
+    while pending:
+      readable, _, _ = select.select(pending.keys(), [], [], settings.REMOTE_STORE_FIND_TIMEOUT)
+      if not readable: # none of the remaining stores answered in time
+        for request in pending.values():
+          request.connection.close()
+          request.store.fail()
+        break
+
+      for sock in readable:
+        yield pending.pop(sock).get_results()
+
+
 def is_local_interface(host):
   if ':' in host:
     host = host.split(':',1)[0]
 
-  for port in xrange(1025, 65535):
+  # Binding to port 0 lets the kernel pick any free port, so a single bind()
+  # per address tells us whether it belongs to one of our interfaces
+  for (family, socktype, proto, canonname, sockaddr) in socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM):
+    sock = None
     try:
-      sock = socket.socket()
-      sock.bind( (host,port) )
-      sock.close()
+      sock = socket.socket(family, socktype, proto)
+      sock.bind( sockaddr[:1] + (0,) + sockaddr[2:] )
 
     except socket.error, e:
-      if e.args[0] == errno.EADDRNOTAVAIL:
-        return False
-      else:
+      if sock is not None:
+        sock.close()
+      if e.args[0] in (errno.EADDRNOTAVAIL, errno.EAFNOSUPPORT):
         continue
+      else:
+        raise
 
     else:
+      sock.close()
       return True
 
-  raise Exception("Failed all attempts at binding to interface %s, last exception was %s" % (host, e))
+  return False
 
 
 def is_pattern(s):
@@ -135,8 +173,10 @@ def find(root_dir, pattern):
   "Generates nodes beneath root_dir matching the given pattern"
   clean_pattern = pattern.replace('\\', '')
   pattern_parts = clean_pattern.split('.')
+  compiled_parts = [ CompiledPattern(part) for part in pattern_parts ]
+  escaped_fields = list( find_escaped_pattern_fields(pattern) )
 
-  for absolute_path in _find(root_dir, pattern_parts):
+  for absolute_path in _find_paths(root_dir, compiled_parts):
 
     if DATASOURCE_DELIMETER in basename(absolute_path):
       (absolute_path,datasource_pattern) = absolute_path.rsplit(DATASOURCE_DELIMETER,1)
@@ -148,7 +188,7 @@ def find(root_dir, pattern):
 
     # Preserve pattern in resulting path for escaped query pattern elements
     metric_path_parts = metric_path.split('.')
-    for field_index in find_escaped_pattern_fields(pattern):
+    for field_index in escaped_fields:
       metric_path_parts[field_index] = pattern_parts[field_index].replace('\\', '')
     metric_path = '.'.join(metric_path_parts)
 
@@ -177,40 +217,155 @@ def find(root_dir, pattern):
               yield source
 
 
-def _find(current_dir, patterns):
-  """Recursively generates absolute paths whose components underneath current_dir
-  match the corresponding pattern in patterns"""
-  pattern = patterns[0]
-  patterns = patterns[1:]
-  entries = os.listdir(current_dir)
+def _find_paths(root_dir, patterns):
+  "Generates the matching paths from root_dir's metric index when it has one, otherwise from disk"
+  index = get_metric_index(root_dir)
+  listings = index and index.listings
 
-  subdirs = [e for e in entries if isdir( join(current_dir,e) )]
-  matching_subdirs = match_entries(subdirs, pattern)
+  if listings:
+    def list_dir(current_dir):
+      if current_dir in listings:
+        return listings[current_dir]
+      else: # beyond a symlink loop
+        return _list_dir(current_dir)
 
-  if len(patterns) == 1 and rrdtool: #the last pattern may apply to RRD data sources
-    files = [e for e in entries if isfile( join(current_dir,e) )]
-    rrd_files = match_entries(files, pattern + ".rrd")
+    found = False
+    for absolute_path in _find(root_dir, patterns, list_dir):
+      found = True
+      yield absolute_path
 
-    if rrd_files: #let's assume it does
-      datasource_pattern = patterns[0]
+    if found:
+      return
 
-      for rrd_file in rrd_files:
-        absolute_path = join(current_dir, rrd_file)
-        yield absolute_path + DATASOURCE_DELIMETER + datasource_pattern
+  # Nothing indexed matched, but it may have been created since the last refresh
+  for absolute_path in _find(root_dir, patterns):
+    yield absolute_path
 
-  if patterns: #we've still got more directories to traverse
-    for subdir in matching_subdirs:
 
-      absolute_path = join(current_dir, subdir)
-      for match in _find(absolute_path, patterns):
-        yield match
+def _find(root_dir, patterns, list_dir=None):
+  """Generates absolute paths whose components underneath root_dir
+  match the corresponding pattern in patterns. list_dir returns the
+  (subdirectories, files) of a directory and defaults to reading the disk"""
+  list_dir = list_dir or _list_dir
+  last_depth = len(patterns) - 1
+  pending = deque([ (root_dir, 0) ]) # directories left to search, deepest first
+
+  while pending:
+    (current_dir, depth) = pending.pop()
+    pattern = patterns[depth]
+    (subdirs, files) = list_dir(current_dir)
+
+    matching_subdirs = filter_entries(subdirs, pattern.regexes)
+
+    if depth == last_depth - 1 and rrdtool: #the last pattern may apply to RRD data sources
+      rrd_files = filter_entries(files, pattern.rrd_regexes)
+
+      if rrd_files: #let's assume it does
+        datasource_pattern = patterns[last_depth].pattern
+
+        for rrd_file in rrd_files:
+          absolute_path = join(current_dir, rrd_file)
+          yield absolute_path + DATASOURCE_DELIMETER + datasource_pattern
+
+    if depth < last_depth: #we've still got more directories to traverse
+      # Pushed in reverse so they are popped, and yielded, in sorted order
+      for subdir in reversed(matching_subdirs):
+        pending.append( (join(current_dir, subdir), depth + 1) )
+
+    else: #we've got the last pattern
+      matching_files = filter_entries(files, pattern.file_regexes)
+
+      for basename in matching_subdirs + matching_files:
+        yield join(current_dir, basename)
+
+
+def _list_dir(current_dir):
+  "Returns the names of the (subdirectories, files) in current_dir"
+  subdirs = []
+  files = []
+
+  if scandir: # the directory entry type comes for free, saving a stat() per entry
+    for entry in scandir(current_dir):
+      if entry.is_dir():
+        subdirs.append(entry.name)
+      elif entry.is_file():
+        files.append(entry.name)
 
-  else: #we've got the last pattern
-    files = [e for e in entries if isfile( join(current_dir,e) )]
-    matching_files = match_entries(files, pattern + '.*')
+  else:
+    for e in os.listdir(current_dir):
+      absolute_path = join(current_dir, e)
+      if isdir(absolute_path):
+        subdirs.append(e)
+      elif isfile(absolute_path):
+        files.append(e)
+
+  return (subdirs, files)
+
+
+class MetricIndex:
+  """In-memory listing of every directory beneath root_dir, so finds don't have to
+  read the disk. A background thread rebuilds it every refresh_interval seconds"""
+  def __init__(self, root_dir, refresh_interval):
+    self.root_dir = root_dir
+    self.refresh_interval = refresh_interval
+    self.listings = None # maps absolute directory paths to their (subdirs, files)
+
+    refresher = threading.Thread(target=self.refresh_forever)
+    refresher.setDaemon(True)
+    refresher.start()
+
+  def refresh_forever(self):
+    while True:
+      start = time.time()
+      try:
+        self.listings = self.build() # swapped in whole, readers keep their own reference
+        log.info("[MetricIndex] indexed %d directories beneath %s in %.6f seconds" % (len(self.listings), self.root_dir, time.time() - start))
+      except:
+        log.exception("[MetricIndex] failed to index %s" % self.root_dir)
+      time.sleep(self.refresh_interval)
+
+  def build(self):
+    listings = {}
+    pending = [ (self.root_dir, frozenset([realpath(self.root_dir)])) ]
+
+    while pending:
+      (current_dir, ancestors) = pending.pop()
+      try:
+        (subdirs, files) = _list_dir(current_dir)
+      except OSError: # unreadable, or removed since its parent was listed
+        log.exception("[MetricIndex] skipping %s" % current_dir)
+        continue
+      listings[current_dir] = (subdirs, files)
+
+      for subdir in subdirs:
+        absolute_path = join(current_dir, subdir)
+        real_path = realpath(absolute_path)
+
+        if real_path not in ancestors: # don't follow symlink loops forever
+          pending.append( (absolute_path, ancestors | frozenset([real_path])) )
+
+    return listings
+
+
+metric_indexes = {} # one MetricIndex per data directory, shared by every Store
+metric_indexes_lock = threading.Lock()
 
-    for basename in matching_subdirs + matching_files:
-      yield join(current_dir, basename)
+
+def get_metric_index(root_dir):
+  "Returns root_dir's MetricIndex, starting it on first use, or None when indexing is disabled"
+  refresh_interval = getattr(settings, 'METRIC_INDEX_REFRESH_INTERVAL', 0)
+  if not refresh_interval:
+    return None
+
+  index = metric_indexes.get(root_dir)
+  if index is None:
+    # Started on first use rather than at import, so pre-forked workers each run their own refresher
+    with metric_indexes_lock:
+      index = metric_indexes.get(root_dir)
+      if index is None:
+        index = metric_indexes[root_dir] = MetricIndex(root_dir, refresh_interval)
+
+  return index
 
 
 def _deduplicate(entries):
@@ -222,27 +377,71 @@ def _deduplicate(entries):
 
 
 def match_entries(entries, pattern):
-  # First we check for pattern variants (ie. {foo,bar}baz = foobaz or barbaz)
+  return filter_entries(entries, compile_pattern(pattern))
+
+
+def compile_pattern(pattern):
+  "Translates a pattern into a list of regexes, one per variant (ie. {foo,bar}baz = foobaz or barbaz)"
   v1, v2 = pattern.find('{'), pattern.find('}')
 
   if v1 > -1 and v2 > v1:
     variations = pattern[v1+1:v2].split(',')
     variants = [ pattern[:v1] + v + pattern[v2+1:] for v in variations ]
+  else:
+    variants = [pattern]
+
+  return [ re.compile(fnmatch.translate(variant)) for variant in variants ]
+
+
+def filter_entries(entries, regexes):
+  if len(regexes) > 1:
     matching = []
 
-    for variant in variants:
-      matching.extend( fnmatch.filter(entries, variant) )
+    for regex in regexes:
+      matching.extend( [e for e in entries if regex.match(e)] )
 
     return list( _deduplicate(matching) ) #remove dupes without changing order
 
   else:
-    matching = fnmatch.filter(entries, pattern)
+    regex = regexes[0]
+    matching = [e for e in entries if regex.match(e)]
     matching.sort()
     return matching
 
 
+class CompiledPattern:
+  "One component of a path pattern, compiled once per query for every way _find matches it"
+  def __init__(self, pattern):
+    self.pattern = pattern
+    self.regexes = compile_pattern(pattern)
+    self.file_regexes = compile_pattern(pattern + '.*')
+    self.rrd_regexes = compile_pattern(pattern + '.rrd')
+
+
+# realpath() stats every component of the path, so resolved paths are remembered
+# for REALPATH_CACHE_DURATION seconds; repointed symlinks are noticed once they expire
+_realpath_cache = {}
+
+def cached_realpath(path):
+  now = time.time()
+
+  cached = _realpath_cache.get(path)
+  if cached is not None:
+    (real_path, expires) = cached
+    if now < expires:
+      return real_path
+
+  if len(_realpath_cache) >= REALPATH_CACHE_SIZE:
+    _realpath_cache.clear()
+
+  real_path = realpath(path)
+  _realpath_cache[path] = (real_path, now + settings.REALPATH_CACHE_DURATION)
+  return real_path
+
+
 # Node classes
-class Node:
+class Node(object):
+  __slots__ = ('fs_path', 'metric_path', 'real_metric', 'name')
   context = {}
   intervals = []
 
@@ -258,6 +457,8 @@ class Node:
 
 class Branch(Node):
   "Node with children"
+  __slots__ = ()
+
   def fetch(self, startTime, endTime):
     "No-op to make all Node's fetch-able"
     return []
@@ -268,18 +469,21 @@ class Branch(Node):
 
 class Leaf(Node):
   "(Abstract) Node that stores data"
+  __slots__ = ()
+
   def isLeaf(self):
     return True
 
 
 # Database File classes
 class WhisperFile(Leaf):
-  cached_context_data = None
+  __slots__ = ('intervals', 'cached_context_data')
   extension = '.wsp'
 
   def __init__(self, *args, **kwargs):
     Leaf.__init__(self, *args, **kwargs)
-    real_fs_path = realpath(self.fs_path)
+    self.cached_context_data = None
+    real_fs_path = cached_realpath(self.fs_path)
 
     start = time.time() - whisper.info(self.fs_path)['maxRetention']
     end = max( os.stat(self.fs_path).st_mtime, start )
@@ -287,7 +491,7 @@ class WhisperFile(Leaf):
 
     if real_fs_path != self.fs_path:
       relative_fs_path = self.metric_path.replace('.', '/') + self.extension
-      base_fs_path = realpath(self.fs_path[ :-len(relative_fs_path) ])
+      base_fs_path = cached_realpath(self.fs_path[ :-len(relative_fs_path) ])
       relative_real_fs_path = real_fs_path[ len(base_fs_path)+1: ]
       self.real_metric = relative_real_fs_path[ :-len(self.extension) ].replace('/', '.')
 
@@ -322,6 +526,7 @@ class WhisperFile(Leaf):
 
 
 class GzippedWhisperFile(WhisperFile):
+  __slots__ = ()
   extension = '.wsp.gz'
 
   def fetch(self, startTime, endTime):
@@ -336,6 +541,8 @@ class GzippedWhisperFile(WhisperFile):
 
 
 class RRDFile(Branch):
+  __slots__ = ()
+
   def getDataSources(self):
     info = rrdtool.info(self.fs_path)
     if 'ds' in info:
@@ -347,6 +554,8 @@ class RRDFile(Branch):
 
 
 class RRDDataSource(Leaf):
+  __slots__ = ('rrd_file',)
+
   def __init__(self, rrd_file, name):
     self.rrd_file = rrd_file
     self.name = name